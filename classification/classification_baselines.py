@@ -1,46 +1,41 @@
 import numpy; numpy.random.seed(42)
-import re
 import pickle
-from typing import List, Dict, Tuple
-from sklearn.feature_extraction.text import TfidfVectorizer
+from typing import List, Tuple
+from sklearn.feature_extraction.text import HashingVectorizer, TfidfTransformer
+from sklearn.pipeline import Pipeline, make_pipeline
 from sklearn.multiclass import OneVsRestClassifier
 from sklearn.preprocessing import MultiLabelBinarizer
 from sklearn.linear_model import LogisticRegression
-from utils import split_corpus, SplitDataSet, evaluate_multilabels, \
+from utils import split_corpus, SplitDataSet, evaluate_multilabels, stringify_labels, \
     tune_clf_thresholds
 
 
+def build_vectorizer(n_features: int = 2 ** 18) -> Pipeline:
+    """
+    TF-IDF vectorizer on hashed term counts, so no vocabulary has to be kept
+    :param n_features: Size of the hash space, close to the vocabulary size since
+    each per-label classifier is trained with a dense weight vector of this size
+    :return: Unfitted pipeline
+    """
+    return make_pipeline(HashingVectorizer(n_features=n_features, alternate_sign=False,
+                                           norm=None, dtype=numpy.float32),
+                         TfidfTransformer(sublinear_tf=True))
+
+
 def train_classifiers(x_train: numpy.array, y_train: numpy.array) -> OneVsRestClassifier:
-    clf = LogisticRegression(class_weight='balanced', max_iter=10000, solver='lbfgs')
+    clf = LogisticRegression(class_weight='balanced', max_iter=1000, tol=1e-3,
+                             solver='saga', penalty='l2')
     ovr = OneVsRestClassifier(clf, n_jobs=-1)
     ovr.fit(x_train, y_train)
+    # Hash buckets no training document hits keep a zero weight, so sparse
+    # coefficients keep the pickled model proportional to the used features
+    # (labels without positives get a constant predictor, which has no weights)
+    for estimator in ovr.estimators_:
+        if isinstance(estimator, LogisticRegression):
+            estimator.sparsify()
     return ovr
 
 
-def stringify_labels(y_vecs: numpy.array, mlb: MultiLabelBinarizer,
-                     thresh: float = 0.5, label_threshs: Dict[str, float] = None) -> List[List[str]]:
-    """
-    Turn prediction probabilities into label strings
-    :param y_vecs:
-    :param mlb:
-    :param thresh:
-    :param label_threshs: Classification threshold per label
-    :return:
-    """
-    y_pred: List[List[str]] = []
-    if not label_threshs:
-        label_threshs = {l: thresh for l in mlb.classes_}
-    label_threshs = [label_threshs[l] for l in mlb.classes_]
-    for prediction in y_vecs:
-        label_indexes = numpy.where(prediction >= label_threshs)[0]
-        if label_indexes.size > 0:  # One of the classes has triggered
-            labels = set(numpy.take(mlb.classes_, label_indexes))
-        else:
-            labels = []
-        y_pred.append(labels)
-    return y_pred
-
-
 def classify_by_labelname(x_test: List[str], y_train: List[List[str]],
                           prop_nda: bool = False) -> List[List[str]]:
 
@@ -52,15 +47,35 @@ def classify_by_labelname(x_test: List[str], y_train: List[List[str]],
         sec2prop = {v: l for l, v in prop2sec.items()}
         label_set = {sec2prop[l].lower() for l in label_set if l in sec2prop}
 
+    # One automaton for all label names and their singular forms, so each
+    # document is scanned once
+    import ahocorasick
+    automaton = ahocorasick.Automaton()
+    for orig_label in label_set:
+        label = orig_label.replace('_', ' ')
+        names = [label, label[:-1]] if label.endswith('s') else [label]
+        for name in names:
+            if name:
+                matches = automaton.get(name, [])
+                automaton.add_word(name, matches + [(orig_label, len(name))])
+    automaton.make_automaton()
+
+    def is_word_char(c: str) -> bool:
+        return c.isalnum() or c == '_'
+
     y_preds = []
     for i, x in enumerate(x_test):
         print(i, '\r', end='', flush=True)
+        x = x.lower()
         y_pred = []
-        for orig_label in label_set:
-            label = orig_label.replace('_', ' ')
-            if re.search(r'\b%s\b' % label, x.lower()) \
-                    or (label.endswith('s') and re.search(r'\b%s\b' % label[:-1], x.lower())):
-                y_pred.append(orig_label)
+        for end, matches in automaton.iter(x):
+            for orig_label, length in matches:
+                start = end - length + 1
+                # Only whole words, as with \b in a regex
+                if (start == 0 or not is_word_char(x[start - 1])) \
+                        and (end + 1 == len(x) or not is_word_char(x[end + 1])) \
+                        and orig_label not in y_pred:
+                    y_pred.append(orig_label)
         y_preds.append(y_pred)
     return y_preds
 
@@ -94,7 +109,7 @@ if __name__ == '__main__':
         breakpoint()
 
     print('Vectorizing')
-    tfidfizer = TfidfVectorizer(sublinear_tf=True)
+    tfidfizer = build_vectorizer()
     x_train_vecs = tfidfizer.fit_transform(dataset.x_train)
     x_test_vecs = tfidfizer.transform(dataset.x_test)
     x_dev_vecs = tfidfizer.transform(dataset.x_dev)
@@ -142,7 +157,7 @@ if __name__ == '__main__':
         evaluate_multilabels(dataset_nda.y_test, y_preds_nda, do_print=True)
 
         print('In-domain: train on proprietary, predict proprietary')
-        tfidfizer_prop = TfidfVectorizer(sublinear_tf=True)
+        tfidfizer_prop = build_vectorizer()
         x_train_prop_vecs = tfidfizer_prop.fit_transform(dataset_nda.x_train)
         x_test_prop_vecs = tfidfizer_prop.transform(dataset_nda.x_test)
         x_dev_prop_vecs = tfidfizer_prop.transform(dataset_nda.x_dev)
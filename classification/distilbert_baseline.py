@@ -1,4 +1,5 @@
 
+import os
 import random
 import argparse
 
@@ -20,13 +21,13 @@ from pytorch_transformers.modeling_distilbert import (
     DistilBertModel,
 )
 
-from sklearn.metrics import f1_score, classification_report
+from sklearn.metrics import classification_report
 
 from tqdm import tqdm, trange
 import numpy as np
 
-from distilbert_data_utils import DonData, convert_examples_to_features
-from utils import evaluate_multilabels
+from distilbert_data_utils import DonData, cached_convert_examples_to_features
+from utils import evaluate_multilabels, tune_label_thresholds, apply_label_thresholds
 
 
 class DistilBertForMultilabelSequenceClassification(DistilBertPreTrainedModel):
@@ -42,6 +43,13 @@ class DistilBertForMultilabelSequenceClassification(DistilBertPreTrainedModel):
 
         self.init_weights()
 
+    def head(self, pooled_output):
+        # pooled output to logits, a single function so it can be compiled as a block
+        pooled_output = self.pre_classifier(pooled_output)
+        pooled_output = nn.functional.relu(pooled_output)
+        pooled_output = self.dropout(pooled_output)
+        return self.classifier(pooled_output)
+
     def forward(
             self,
             input_ids,
@@ -57,10 +65,7 @@ class DistilBertForMultilabelSequenceClassification(DistilBertPreTrainedModel):
         )
         hidden_state = distilbert_output[0]
         pooled_output = hidden_state[:, 0]
-        pooled_output = self.pre_classifier(pooled_output)
-        pooled_output = nn.ReLU()(pooled_output)
-        pooled_output = self.dropout(pooled_output)
-        logits = self.classifier(pooled_output)
+        logits = self.head(pooled_output)
 
         outputs = (logits,) + distilbert_output[1:]
         if labels is not None:
@@ -101,6 +106,9 @@ def train(train_dataset, model, train_params, class_weights=None):
         train_dataset,
         sampler=train_sampler,
         batch_size=batch_size,
+        num_workers=4,
+        pin_memory=torch.cuda.is_available(),
+        persistent_workers=True,
     )
 
     if class_weights is not None:
@@ -143,7 +151,7 @@ def train(train_dataset, model, train_params, class_weights=None):
         epoch_iter = tqdm(train_dataloader, desc="Iteration")
         for step, batch in enumerate(epoch_iter):
             model.train()
-            batch = tuple(t.to(device) for t in batch)
+            batch = tuple(t.to(device, non_blocking=True) for t in batch)
             inputs = {
                 'input_ids': batch[0],
                 'attention_mask': batch[1],
@@ -176,19 +184,29 @@ def evaluate(eval_dataset, model):
     batch_size = 8
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
     eval_sampler = SequentialSampler(eval_dataset)
+    # Workers keep the next batches ready while the model runs
     eval_loader = DataLoader(
         eval_dataset,
         sampler=eval_sampler,
-        batch_size=batch_size
+        batch_size=batch_size,
+        num_workers=4,
+        pin_memory=torch.cuda.is_available(),
+        prefetch_factor=4,
     )
 
-    preds = None
-    out_label_ids = None
+    # Half precision matmuls on GPU, bfloat16 where supported; with autocast
+    # disabled on CPU the dtype still has to be one CPU autocast accepts
+    use_amp = device.type == 'cuda'
+    amp_dtype = torch.float16 if use_amp and not torch.cuda.is_bf16_supported() else torch.bfloat16
+
+    # outputs stay on the device until the end, one copy to host instead of one per batch
+    model.eval()
+    preds_list = []
+    labels_list = []
     for batch in tqdm(eval_loader, desc="Evaluation"):
-        model.eval()
-        batch = tuple(t.to(device) for t in batch)
+        batch = tuple(t.to(device, non_blocking=True) for t in batch)
 
-        with torch.no_grad():
+        with torch.inference_mode(), torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=use_amp):
             inputs = {
                 'input_ids': batch[0],
                 'attention_mask': batch[1],
@@ -196,18 +214,11 @@ def evaluate(eval_dataset, model):
                 'labels': batch[3]
             }
             outputs = model(**inputs)
-            logits = outputs[1]
+            preds_list.append(outputs[1].float())
+            labels_list.append(inputs['labels'])
 
-            if preds is None:
-                preds = logits.detach().cpu().numpy()
-                out_label_ids = inputs['labels'].detach().cpu().numpy()
-            else:
-                preds = np.append(preds, logits.detach().cpu().numpy(), axis=0)
-                out_label_ids = np.append(
-                    out_label_ids,
-                    inputs['labels'].detach().cpu().numpy(),
-                    axis=0,
-                )
+    preds = torch.cat(preds_list).cpu().numpy()
+    out_label_ids = torch.cat(labels_list).cpu().numpy()
 
     return {
         'pred': sigmoid(preds),
@@ -215,52 +226,25 @@ def evaluate(eval_dataset, model):
     }
 
 
-def tune_threshs(probas, truth):
-    res = np.zeros(probas.shape[1])
-
-    assert np.alltrue(probas > 0.0)
-    assert np.alltrue(probas < 1.0)
-
-    for i in range(probas.shape[1]):
-        if np.sum(truth[:, i]) > 4 :
-            thresh = max(
-                np.linspace(
-                    0.0,
-                    1.0,
-                    num=100,
-                ),
-                key=lambda t: f1_score(y_true=truth[:, i], y_pred=(probas[:, i] > t), pos_label=1, average='binary')
-            )
-            res[i] = thresh
-        else:
-            # res[i] = np.max(probas[:, i])
-            res[i] = 0.5
-
-    return res
-
-
-def apply_threshs(probas, threshs):
-    res = np.zeros(probas.shape)
-
-    for i in range(probas.shape[1]):
-        res[:, i] = probas[:, i] > threshs[i]
-
-    return res
-
-
 def multihot_to_label_lists(label_array, label_map):
     label_id_to_label = {
         v: k
         for k, v in label_map.items()
     }
-    res = []
-    for i in range(label_array.shape[0]):
-        lbl_set = []
-        for j in range(label_array.shape[1]):
-            if label_array[i, j] > 0:
-                lbl_set.append(label_id_to_label[j])
-        res.append(lbl_set)
-    return res
+    id_to_label = np.array(
+        [label_id_to_label[j] for j in range(label_array.shape[1])],
+        dtype=object,
+    )
+    if label_array.shape[0] == 0:
+        return []
+
+    # nonzero is row-major, so the labels of each row are contiguous
+    rows, cols = np.nonzero(label_array > 0)
+    split_points = np.searchsorted(rows, np.arange(1, label_array.shape[0]))
+    return [
+        lbls.tolist()
+        for lbls in np.split(id_to_label[cols], split_points)
+    ]
 
 
 def subsample(data, quantile, n_classes):
@@ -325,6 +309,9 @@ def main():
     )
     model.to(device)
 
+    # identifies the tokenized splits for the feature cache
+    data_key = (os.path.abspath(args.data), os.stat(args.data).st_mtime_ns, model_name)
+
     if args.mode == 'train':
 
         train_params = {
@@ -349,10 +336,11 @@ def main():
             )
 
         print('construct training data tensor')
-        train_data = convert_examples_to_features(
+        train_data = cached_convert_examples_to_features(
             examples=train_data,
             max_seq_length=max_seq_length,
             tokenizer=tokenizer,
+            cache_key=data_key + ('train', args.subsample_quantile),
         )
         print('start training')
         train(
@@ -370,18 +358,24 @@ def main():
         else:
             model = torch.load(args.model_path, map_location='cpu')
 
+    # fuse the classification head for inference; the compiled function only
+    # shadows the method on this instance, it is neither saved nor in the state dict
+    if device.type == 'cuda' and hasattr(torch, 'compile'):
+        model.head = torch.compile(model.head, mode='reduce-overhead')
+
     print('construct dev tensor')
-    dev_data = convert_examples_to_features(
+    dev_data = cached_convert_examples_to_features(
         examples=don_data.dev(),
         max_seq_length=max_seq_length,
         tokenizer=tokenizer,
+        cache_key=data_key + ('dev',),
     )
     
     print('predict dev set')
     prediction_data = evaluate(eval_dataset=dev_data, model=model)
     
     print('tuning clf thresholds on dev')
-    threshs = tune_threshs(
+    threshs = tune_label_thresholds(
         probas=prediction_data['pred'],
         truth=prediction_data['truth'],
     )
@@ -389,10 +383,11 @@ def main():
     # eval
     print("using 'test' for computing test performance")
     print('construct test tensor')
-    test_data = convert_examples_to_features(
+    test_data = cached_convert_examples_to_features(
         examples=don_data.test(),
         max_seq_length=max_seq_length,
         tokenizer=tokenizer,
+        cache_key=data_key + ('test',),
     )
 
     print('predict test set')
@@ -400,7 +395,7 @@ def main():
 
     # tune thresholds
     print('apply clf thresholds')
-    predicted_mat = apply_threshs(
+    predicted_mat = apply_label_thresholds(
         probas=prediction_data['pred'],
         threshs=threshs,
     )
@@ -1,5 +1,7 @@
 
+import hashlib
 import itertools
+from pathlib import Path
 
 import torch
 from torch.utils.data import TensorDataset
@@ -152,3 +154,43 @@ def convert_examples_to_features(
         segment_id_tensor,
         label_id_tensor,
     )
+
+
+def cached_convert_examples_to_features(
+        examples,
+        max_seq_length,
+        tokenizer,
+        cache_key,
+        cache_dir='.cache',
+):
+    # tokenization is slow, so the resulting tensors are stored under a hash
+    # of cache_key, which has to identify the examples and the tokenizer
+    digest = hashlib.blake2b(
+        repr((cache_key, max_seq_length)).encode('utf-8'),
+        digest_size=16,
+    ).hexdigest()
+    cache_file = Path(cache_dir) / f'{digest}.pt'
+
+    if cache_file.exists():
+        features = torch.load(cache_file)
+        return TensorDataset(
+            features['input_ids'],
+            features['input_mask'],
+            features['segment_ids'],
+            features['label_ids'],
+        )
+
+    dataset = convert_examples_to_features(
+        examples=examples,
+        max_seq_length=max_seq_length,
+        tokenizer=tokenizer,
+    )
+    input_ids, input_mask, segment_ids, label_ids = dataset.tensors
+    cache_file.parent.mkdir(parents=True, exist_ok=True)
+    torch.save({
+        'input_ids': input_ids,
+        'input_mask': input_mask,
+        'segment_ids': segment_ids,
+        'label_ids': label_ids,
+    }, cache_file)
+    return dataset
@@ -56,7 +56,7 @@ if __name__ == '__main__':
 
     embedding_file = sys.argv[2]
     vocab_file = sys.argv[3]
-    embeddings = numpy.load(embedding_file)
+    embeddings = numpy.load(embedding_file, mmap_mode='r')
     vocab_en = json.load(open(vocab_file))
     print('Preprocessing')
     train_x = embed(dataset.x_train, embeddings, vocab_en, use_tfidf=use_tfidf, avg_method='mean')
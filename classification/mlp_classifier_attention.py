@@ -2,32 +2,39 @@
 Sentence classification with self-attention in keras
 """
 
+import hashlib
 import json
+import os
+import pickle
 import numpy; numpy.random.seed(42)
-import re
 from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from pathlib import Path
 from sklearn.preprocessing import MultiLabelBinarizer
-from sklearn.metrics import f1_score
 from tensorflow.keras.layers import Input, Embedding, Dense
 from tensorflow.keras.models import Model, load_model
 from tensorflow.keras.preprocessing.sequence import pad_sequences
 from tensorflow.keras.callbacks import EarlyStopping
 from attn_layer import AttentionLayer
 from utils import embed, SplitDataSet, split_corpus, stringify_labels, \
-    evaluate_multilabels, tune_clf_thresholds, calc_class_weights
+    evaluate_multilabels, tune_clf_thresholds, calc_class_weights, TOKEN_RE
 
 
-def build_model(max_sent_length, vocab2int, embeddings, num_labels):
+def build_model(vocab2int, embeddings, num_labels):
     embedding_dim = embeddings[0].shape[0]
 
-    input_layer = Input(shape=(max_sent_length,))
+    # Variable length input, so predictions can be run on shorter padding
+    input_layer = Input(shape=(None,))
 
+    # The frozen table is stored in half precision, AttentionLayer casts the
+    # looked up vectors back to float32
     embedding_layer = Embedding(len(vocab2int),
                                 embedding_dim,
-                                weights=[embeddings],
-                                input_length=max_sent_length,
+                                weights=[embeddings.astype(numpy.float16)],
                                 trainable=False,
-                                mask_zero=True)
+                                mask_zero=True,
+                                dtype='float16')
 
     embedded = embedding_layer(input_layer)
 
@@ -49,29 +56,154 @@ def build_model(max_sent_length, vocab2int, embeddings, num_labels):
     return model
 
 
-def tune_threshs(probas, truth):
-    res = numpy.zeros(probas.shape[1])
-
-    for i in range(probas.shape[1]):
-        thresh = max(
-            numpy.linspace(
-                numpy.min(probas[:, i]),
-                numpy.max(probas[:, i]),
-                num=100,
-            ),
-            key=lambda t: f1_score(y_true=truth[:, i], y_pred=(probas[:, i] > t))
-        )
-        res[i] = thresh
-
-    res[res == 0] = 0.5
-
-    return res
+def token_cache_file(corpus_file, vocab_file, split):
+    """
+    Cache file for the token ids of one split, invalidated when either the
+    corpus or the vocabulary changes
+    """
+    corpus_mtime = os.stat(corpus_file).st_mtime_ns
+    vocab_mtime = os.stat(vocab_file).st_mtime_ns
+    return f'.cache/{Path(corpus_file).stem}_{split}_{corpus_mtime}_{vocab_mtime}.pkl'
+
+
+def tokenize_to_ids(texts, vocab, cache_file=None):
+    """
+    Map each text to the vocabulary ids of its lowercased words, dropping OOVs
+    :param texts: List of texts
+    :param vocab: Word to id mapping
+    :param cache_file: Pickle file to memoize the result in
+    :return: List of id lists
+    """
+    if cache_file is not None and os.path.exists(cache_file):
+        with open(cache_file, 'rb') as f:
+            return pickle.load(f)
+
+    vocab_get = vocab.get
+    x_int = [[i for i in map(vocab_get, TOKEN_RE.findall(x_.lower())) if i is not None]
+             for x_ in texts]
+
+    if cache_file is not None:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        with open(cache_file, 'wb') as f:
+            pickle.dump(x_int, f)
+    return x_int
+
+
+def build_inference_model(model, embeddings):
+    """
+    Model sharing the trained attention and dense layers of a build_model
+    model, fed with looked up embeddings and a padding mask instead of ids
+    :param model: Model built by build_model
+    :param embeddings: Embedding table the lookups are done in, has to be the one the model was trained with
+    """
+    embedding_layer = next(l for l in model.layers if isinstance(l, Embedding))
+    assert embeddings.shape == (embedding_layer.input_dim, embedding_layer.output_dim), \
+        f'Embeddings of shape {embeddings.shape} do not match the embedding layer of the model ' \
+        f'of shape ({embedding_layer.input_dim}, {embedding_layer.output_dim})'
+    attention_layer = next(l for l in model.layers if isinstance(l, AttentionLayer))
+    dense_layers = [l for l in model.layers if isinstance(l, Dense)]
+
+    embedded = Input(shape=(None, embedding_layer.output_dim))
+    mask = Input(shape=(None,), dtype='bool')
+    output = attention_layer(embedded, mask=mask)
+    for dense_layer in dense_layers:
+        output = dense_layer(output)
+
+    return Model(inputs=[embedded, mask], outputs=output)
+
+
+def embedding_lookup(embeddings, maxsize=10000):
+    """
+    Memoized lookup of single embedding rows, so frequent tokens are only
+    fetched from the embedding table once
+    :param embeddings: Embedding table
+    :param maxsize: Number of rows to keep
+    :return: Function mapping a token id to its embedding
+    """
+    @lru_cache(maxsize=maxsize)
+    def lookup(token_id):
+        # Same precision as the Embedding layer of build_model
+        return numpy.asarray(embeddings[token_id], dtype=numpy.float16)
+    return lookup
+
+
+def embed_batch(x_batch, lookup):
+    """
+    Embed a padded batch of ids, looking up every distinct id once
+    :return: Embedded batch and its padding mask
+    """
+    ids, inverse = numpy.unique(x_batch, return_inverse=True)
+    rows = numpy.stack([lookup(int(i)) for i in ids]).astype(numpy.float32)
+    return rows[inverse.reshape(x_batch.shape)], x_batch != 0
+
+
+def prediction_cache_file(model_file, embedding_file, x_int, max_sent_length):
+    """
+    Cache file for the predictions of a saved model on x_int, invalidated
+    when the model is saved again, or the embeddings or the input change
+    """
+    model_mtime = os.stat(model_file).st_mtime_ns
+    embedding_key = (os.path.abspath(embedding_file), os.stat(embedding_file).st_mtime_ns)
+    digest = hashlib.blake2b(pickle.dumps((embedding_key, x_int, max_sent_length)),
+                             digest_size=16).hexdigest()
+    return f'.cache/{Path(model_file).stem}_{model_mtime}_{digest}.npy'
+
+
+def predict_bucketed(model, x_int, max_sent_length, lookup=None, bucket_size=32, batch_size=32,
+                     cache_file=None):
+    """
+    Predict with every sentence padded to the next multiple of bucket_size
+    instead of max_sent_length
+    :param model: Model built by build_model, or by build_inference_model if lookup is given
+    :param x_int: List of id lists
+    :param max_sent_length: Length sentences are truncated to
+    :param lookup: Embedding lookup from embedding_lookup
+    :param bucket_size: Granularity of the padded lengths
+    :param batch_size: Prediction batch size
+    :param cache_file: .npy file to memoize the predictions in
+    :return: Prediction probabilities in the order of x_int
+    """
+    if cache_file is not None and os.path.exists(cache_file):
+        return numpy.load(cache_file)
+
+    lengths = numpy.array([min(len(x_), max_sent_length) for x_ in x_int])
+    bucket_lengths = numpy.minimum(numpy.maximum(-(-lengths // bucket_size), 1) * bucket_size,
+                                   max_sent_length)
+    batches = []
+    for bucket_length in numpy.unique(bucket_lengths):
+        ixs = numpy.where(bucket_lengths == bucket_length)[0]
+        x_bucket = pad_sequences([x_int[i] for i in ixs], int(bucket_length), truncating='post')
+        for start in range(0, len(ixs), batch_size):
+            batches.append((ixs[start:start + batch_size], x_bucket[start:start + batch_size]))
+
+    def prepare(x_batch):
+        if lookup is not None:
+            return list(embed_batch(x_batch, lookup))
+        return x_batch
+
+    y_pred = numpy.zeros((len(x_int), model.output_shape[-1]), dtype=numpy.float32)
+    if not batches:
+        return y_pred
+
+    # Prepare the next batch in the background while the current one is predicted
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        next_batch = executor.submit(prepare, batches[0][1])
+        for k, (ixs_batch, _) in enumerate(batches):
+            x_batch = next_batch.result()
+            if k + 1 < len(batches):
+                next_batch = executor.submit(prepare, batches[k + 1][1])
+            y_pred[ixs_batch] = model.predict_on_batch(x_batch)
+
+    if cache_file is not None:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        numpy.save(cache_file, y_pred)
+    return y_pred
 
 
 def count_oovs(x):
     oovs = Counter()
     for x_ in x:
-        oov = [w for w in re.findall('\w+', x_) if w.lower() not in vocab]
+        oov = [w for w in TOKEN_RE.findall(x_) if w.lower() not in vocab]
         for w in oov:
             oovs[w] += 1
     return oovs
@@ -85,7 +217,6 @@ if __name__ == '__main__':
     classification_thresh = 0.5
 
     import sys
-    from pathlib import Path
     corpus_file = sys.argv[1]
     model_name = f'saved_models/MLP_avg_{Path(corpus_file).stem}.h5'
     Path(model_name).parent.mkdir(parents=True, exist_ok=True)
@@ -93,7 +224,9 @@ if __name__ == '__main__':
     embedding_file = sys.argv[2]
     vocab_file = sys.argv[3]
 
-    embeddings = numpy.load(embedding_file)
+    # Memory mapped, rows are only read in when build_model copies the table
+    # for training or when they are looked up for prediction
+    embeddings = numpy.load(embedding_file, mmap_mode='r')
     vocab = json.load(open(vocab_file))
     int2vocab = {i: w for w, i in vocab.items()}
     embedding_dim = embeddings[0].shape[0]
@@ -113,20 +246,20 @@ if __name__ == '__main__':
     test_y = mlb.transform(dataset.y_test)
     dev_y = mlb.transform(dataset.y_dev)
 
-    train_x_int = [[vocab[w] for w in re.findall('\w+', x_.lower()) if w in vocab]
-                   for x_ in dataset.x_train]
-    test_x_int = [[vocab[w] for w in re.findall('\w+', x_.lower()) if w in vocab]
-                  for x_ in dataset.x_test]
-    dev_x_int = [[vocab[w] for w in re.findall('\w+', x_.lower()) if w in vocab]
-                 for x_ in dataset.x_dev]
+    train_x_int = tokenize_to_ids(dataset.x_train, vocab,
+                                  token_cache_file(corpus_file, vocab_file, 'train'))
+    test_x_int = tokenize_to_ids(dataset.x_test, vocab,
+                                 token_cache_file(corpus_file, vocab_file, 'test'))
+    dev_x_int = tokenize_to_ids(dataset.x_dev, vocab,
+                                token_cache_file(corpus_file, vocab_file, 'dev'))
 
-    max_sent_length = max([len(x_) for x_ in train_x_int])
-    train_x = pad_sequences(train_x_int, max_sent_length)
-    test_x = pad_sequences(test_x_int, max_sent_length)
-    dev_x = pad_sequences(dev_x_int, max_sent_length)
+    # Don't pad everything to the few very long provisions
+    max_sent_length = int(numpy.percentile([len(x_) for x_ in train_x_int], 95))
+    train_x = pad_sequences(train_x_int, max_sent_length, truncating='post')
+    dev_x = pad_sequences(dev_x_int, max_sent_length, truncating='post')
 
     if do_train:
-        model = build_model(max_sent_length, vocab, embeddings, num_classes)
+        model = build_model(vocab, embeddings, num_classes)
         print(model.summary())
 
         class_weights = calc_class_weights(train_y, mlb.classes_)
@@ -154,11 +287,21 @@ if __name__ == '__main__':
         model = load_model(model_name,
                            custom_objects={'AttentionLayer': AttentionLayer})
 
+    # Only the embeddings of tokens that occur are looked up for prediction
+    inference_model = build_inference_model(model, embeddings)
+    lookup = embedding_lookup(embeddings)
+
     if do_test:
         print('predicting')
-        y_pred_bin_dev = model.predict(dev_x, verbose=1)
+        y_pred_bin_dev = predict_bucketed(
+            inference_model, dev_x_int, max_sent_length, lookup,
+            cache_file=prediction_cache_file(model_name, embedding_file,
+                                             dev_x_int, max_sent_length))
         label_threshs = tune_clf_thresholds(y_pred_bin_dev, dataset.y_dev, mlb)
-        y_pred_bin = model.predict(test_x, verbose=1)
+        y_pred_bin = predict_bucketed(
+            inference_model, test_x_int, max_sent_length, lookup,
+            cache_file=prediction_cache_file(model_name, embedding_file,
+                                             test_x_int, max_sent_length))
         y_pred = stringify_labels(y_pred_bin, mlb, label_threshs=label_threshs)
         evaluate_multilabels(dataset.y_test, y_pred, do_print=True)
 
@@ -171,17 +314,20 @@ if __name__ == '__main__':
         test_y = mlb.transform(dataset.y_test)
         dev_y = mlb.transform(dataset.y_dev)
 
-        test_x_int = [[vocab[w] for w in re.findall('\w+', x_.lower()) if w in vocab]
-                      for x_ in dataset.x_test]
-        dev_x_int = [[vocab[w] for w in re.findall('\w+', x_.lower()) if w in vocab]
-                     for x_ in dataset.x_dev]
-
-        test_x = pad_sequences(test_x_int, max_sent_length)
-        dev_x = pad_sequences(dev_x_int, max_sent_length)
+        test_x_int = tokenize_to_ids(dataset.x_test, vocab,
+                                     token_cache_file(nda_file, vocab_file, 'test'))
+        dev_x_int = tokenize_to_ids(dataset.x_dev, vocab,
+                                    token_cache_file(nda_file, vocab_file, 'dev'))
 
         print('predicting NDA')
-        y_pred_bin_dev = model.predict(dev_x, verbose=1)
+        y_pred_bin_dev = predict_bucketed(
+            inference_model, dev_x_int, max_sent_length, lookup,
+            cache_file=prediction_cache_file(model_name, embedding_file,
+                                             dev_x_int, max_sent_length))
         label_threshs = tune_clf_thresholds(y_pred_bin_dev, dataset.y_dev, mlb)
-        y_pred_bin = model.predict(test_x, verbose=1)
+        y_pred_bin = predict_bucketed(
+            inference_model, test_x_int, max_sent_length, lookup,
+            cache_file=prediction_cache_file(model_name, embedding_file,
+                                             test_x_int, max_sent_length))
         y_pred = stringify_labels(y_pred_bin, mlb, label_threshs=label_threshs)
         evaluate_multilabels(dataset.y_test, y_pred, do_print=True)
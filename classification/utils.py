@@ -3,12 +3,17 @@ import numpy
 import re
 from typing import List, Union, Dict, DefaultDict, Tuple
 from collections import defaultdict
+from joblib import Parallel, delayed
+from numba import njit, prange
 # from dataclasses import dataclass
 from sklearn.model_selection import train_test_split
 from sklearn.preprocessing import MultiLabelBinarizer
 from sklearn.feature_extraction.text import TfidfVectorizer
 
 
+TOKEN_RE = re.compile(r'\w+')
+
+
 """
 @dataclass
 class SplitDataSet:
@@ -162,17 +167,18 @@ def stringify_labels(y_vecs: numpy.array, mlb: MultiLabelBinarizer,
     :param label_threshs: Classification threshold per label
     :return:
     """
-    y_pred: List[List[str]] = []
+    if len(y_vecs) == 0:
+        return []
+    # Object array, so the label strings are shared rather than copied per prediction
+    classes = numpy.asarray(mlb.classes_, dtype=object)
     if not label_threshs:
-        label_threshs = {l: thresh for l in mlb.classes_}
-    label_threshs = [label_threshs[l] for l in mlb.classes_]
-    for prediction in y_vecs:
-        label_indexes = numpy.where(prediction >= label_threshs)[0]
-        if label_indexes.size > 0:  # One of the classes has triggered
-            labels = set(numpy.take(mlb.classes_, label_indexes))
-        else:
-            labels = []
-        y_pred.append(labels)
+        threshs_vec = numpy.full(len(classes), thresh)
+    else:
+        threshs_vec = numpy.array([label_threshs[l] for l in classes])
+    rows, cols = numpy.nonzero(y_vecs >= threshs_vec[numpy.newaxis, :])
+    # Row-major order of nonzero groups the triggered labels by prediction
+    row_starts = numpy.searchsorted(rows, numpy.arange(1, len(y_vecs)))
+    y_pred: List[List[str]] = [labels.tolist() for labels in numpy.split(classes[cols], row_starts)]
     return y_pred
 
 
@@ -225,7 +231,7 @@ def embed(x_s: List[str], embeddings: numpy.array, vocab: Dict, tfidfizer: Tfidf
     else:
         for x in x_s:
             x_embedded = []
-            words = re.findall('\w+', x.lower())
+            words = TOKEN_RE.findall(x.lower())
             for word in words:
                 if word in vocab:
                     x_embedded.append(embeddings[vocab[word]])
@@ -235,6 +241,47 @@ def embed(x_s: List[str], embeddings: numpy.array, vocab: Dict, tfidfizer: Tfidf
     return numpy.array(x_vecs)
 
 
+def _column_counts(probas: numpy.array, truth: numpy.array,
+                   thresh_range: numpy.array) -> Tuple[numpy.array, numpy.array]:
+    """
+    Count true positives and predictions of a single label per threshold
+    :param probas: Prediction probabilities of the label
+    :param truth: Gold labels, 1 where the label applies
+    :param thresh_range: Thresholds, the label is predicted if its probability is >= the threshold
+    :return: TP counts and prediction counts per threshold
+    """
+    order = numpy.argsort(-probas, kind='stable')
+    # cum_tp[k] holds the true positives among the k highest scores
+    cum_tp = numpy.concatenate([[0], numpy.cumsum(truth[order])])
+    # Number of predictions per threshold, searched on the ascending negated scores
+    n_pred = numpy.searchsorted(-probas[order], -thresh_range, side='right')
+    return cum_tp[n_pred], n_pred
+
+
+def _threshold_counts(y_pred_vecs: numpy.array, y_true_vecs: numpy.array,
+                      thresh_range: numpy.array) -> Tuple[numpy.array, numpy.array, numpy.array]:
+    """
+    Count true positives, false positives and false negatives per threshold and label
+    :param y_pred_vecs: Prediction probabilities, shape (samples, labels)
+    :param y_true_vecs: Multi-hot gold labels, shape (samples, labels)
+    :param thresh_range: Thresholds, a label is predicted if its probability is >= the threshold
+    :return: TP, FP and FN counts, each of shape (thresholds, labels)
+    """
+    # Labels are independent, and sorting releases the GIL
+    y_pred_vecs = numpy.asfortranarray(y_pred_vecs)
+    y_true_vecs = numpy.asfortranarray(y_true_vecs)
+    counts = Parallel(n_jobs=-1, prefer='threads')(
+        delayed(_column_counts)(y_pred_vecs[:, j], y_true_vecs[:, j], thresh_range)
+        for j in range(y_pred_vecs.shape[1])
+    )
+
+    tp = numpy.stack([col_tp for col_tp, _ in counts], axis=1)
+    n_pred = numpy.stack([col_n_pred for _, col_n_pred in counts], axis=1)
+    fp = n_pred - tp
+    fn = y_true_vecs.sum(axis=0) - tp
+    return tp, fp, fn
+
+
 def tune_clf_thresholds(y_pred_vecs: numpy.array, test_y: List[List[str]],
                         mlb: MultiLabelBinarizer,
                         objective: str = 'f1',
@@ -243,59 +290,93 @@ def tune_clf_thresholds(y_pred_vecs: numpy.array, test_y: List[List[str]],
     assert objective in {'f1', 'balanced', 'std'}, \
         f'{objective} not a valid tuning objective for classifier threshold'
 
-    thresh_range = [t / 100.0 for t in range(1, 100)]
-    all_results = dict()
-    for thresh in thresh_range:
-        y_pred = stringify_labels(y_pred_vecs, mlb, thresh=thresh)
-        eval_results = evaluate_multilabels(test_y, y_pred, do_print=False)
-        all_results[thresh] = eval_results
+    thresh_range = numpy.array([t / 100.0 for t in range(1, 100)])
+    tp, fp, fn = _threshold_counts(y_pred_vecs, mlb.transform(test_y), thresh_range)
+
+    # Same scores as evaluate_multilabels, for all thresholds and labels at once
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        prec = numpy.where(tp > 0, tp / (tp + fp), 0.0)
+        rec = numpy.where(tp > 0, tp / (tp + fn), 0.0)
+        f1 = numpy.where(tp > 0, (2 * prec * rec) / (prec + rec), 0.0)
+
+    if objective == 'f1':
+        scores = f1
+    elif objective == 'balanced':
+        scores = rec + prec + f1
+    elif objective == 'std':
+        scores = -numpy.std(numpy.stack([rec, prec, f1]), axis=0)
+
+    # On ties, prefer the highest threshold
+    best_ixs = len(thresh_range) - 1 - numpy.argmax(scores[::-1], axis=0)
 
     # Don't tune threshholds for labels with less than min_freq support in dev
-    eval_results = all_results[thresh_range[0]]
-    low_freq_labels = {l for l, res_dict in eval_results.items() if
-                       res_dict['support'] < min_freq}
+    support = tp[0] + fn[0]
 
     label_threshs: Dict[str, float] = dict()
-    if objective == 'f1':
-        for label in mlb.classes_:
-            if label in low_freq_labels:
-                label_threshs[label] = 0.5
-            else:
-                best_thresh, best_f1 = min(thresh_range), 0.0
-                for t in thresh_range:
-                    if all_results[t][label]['f1'] >= best_f1:  # Changing this to '>' favors recall more.
-                        best_thresh, best_f1 = t, all_results[t][label]['f1']
-                label_threshs[label] = best_thresh
+    for j, label in enumerate(mlb.classes_):
+        if support[j] < min_freq:
+            label_threshs[label] = 0.5
+        else:
+            label_threshs[label] = float(thresh_range[best_ixs[j]])
 
-    elif objective == 'balanced':
-        for label in mlb.classes_:
-            if label in low_freq_labels:
-                label_threshs[label] = 0.5
-            else:
-                best_thresh, best_balance = min(thresh_range), 0.0
-                for t in thresh_range:
-                    balance = all_results[t][label]['rec'] \
-                              + all_results[t][label]['prec'] \
-                              + all_results[t][label]['f1']
-                    if balance >= best_balance:
-                        best_thresh, best_balance = t, balance
-                label_threshs[label] = best_thresh
+    return label_threshs
 
-    elif objective == 'std':
-        for label in mlb.classes_:
-            if label in low_freq_labels:
-                label_threshs[label] = 0.5
+
+@njit(parallel=True, cache=True)
+def _tune(probas, truth, out):
+    n_samples = probas.shape[0]
+    for i in prange(probas.shape[1]):
+        order = numpy.argsort(-probas[:, i])
+        support = 0
+        for k in range(n_samples):
+            if truth[k, i] > 0:
+                support += 1
+
+        # Walk the threshold down the sorted probas, scoring every cut
+        # between two distinct scores
+        tp = 0
+        fp = 0
+        best_f1 = 0.0
+        best_thresh = 0.5
+        for k in range(n_samples):
+            if truth[order[k], i] > 0:
+                tp += 1
             else:
-                best_thresh, best_balance = min(thresh_range), 1.0
-                for t in thresh_range:
-                    balance = numpy.std([all_results[t][label]['rec'],
-                                         all_results[t][label]['prec'],
-                                         all_results[t][label]['f1']])
-                    if balance <= best_balance:
-                        best_thresh, best_balance = t, balance
-                label_threshs[label] = best_thresh
+                fp += 1
+            proba = probas[order[k], i]
+            next_proba = probas[order[k + 1], i] if k + 1 < n_samples else 0.0
+            if next_proba == proba:  # Ties can't be split by a threshold
+                continue
+            f1 = 2.0 * tp / (2 * tp + fp + support - tp)
+            if f1 > best_f1:
+                best_f1 = f1
+                best_thresh = (proba + next_proba) / 2
+        out[i] = best_thresh
+
+
+def tune_label_thresholds(probas: numpy.array, truth: numpy.array,
+                          min_freq: int = 5) -> numpy.array:
+    """
+    Find the F1 maximizing classification threshold of each label
+    :param probas: Prediction probabilities, shape (samples, labels)
+    :param truth: Multi-hot gold labels, shape (samples, labels)
+    :param min_freq: Labels with less positive samples keep a threshold of 0.5
+    :return: Threshold per label, to be applied with apply_label_thresholds
+    """
+    res = numpy.zeros(probas.shape[1])
+    _tune(probas, truth, res)
+    res[numpy.sum(truth, axis=0) < min_freq] = 0.5
+    return res
 
-    return label_threshs
+
+def apply_label_thresholds(probas: numpy.array, threshs: numpy.array) -> numpy.array:
+    """
+    Turn prediction probabilities into multi-hot predictions
+    :param probas: Prediction probabilities, shape (samples, labels)
+    :param threshs: Threshold per label
+    :return: Multi-hot predictions, shape (samples, labels)
+    """
+    return (probas > numpy.asarray(threshs)[numpy.newaxis, :]).astype(numpy.float64)
 
 
 def calc_class_weights(y: numpy.array, label2ix: Dict[str, int])\